@@ -7,7 +7,6 @@ import traceback
 import random
 import difflib
 from urllib import request
-from urllib.parse import urljoin
 import http
 from inspect import cleandoc
 import os
@@ -98,16 +97,27 @@ class Tester:
         return TestEntry(self, print_args)
 
 RANDOM_NUMBER_PREFIX = "Here's a random number: "
-RANDOM_NUMBER_REGEX = re.escape(RANDOM_NUMBER_PREFIX) + r'\d+'
+RANDOM_NUMBER_RE = re.compile(re.escape(RANDOM_NUMBER_PREFIX) + r'\d+')
 
 def relate(base, relative=None, *more):
     if relative is None:
         return base
     
-    dot = hex(random.randrange(2**128))[2:]
-    base = base.replace('.', dot)
-    relative = relative.replace('.', dot)
-    result = urljoin(base, relative).replace(dot, '.')
+    if '://' in relative:
+        result = relative
+    elif relative == '':
+        result = base
+    else:
+        # Join by hand rather than with urljoin, which would collapse '.' and
+        # '..' segments before they ever reach the server
+        scheme, _, rest = base.partition('://')
+        authority, slash, path = rest.partition('/')
+        if relative.startswith('/'):
+            path = relative
+        else:
+            path = (slash + path) or '/'
+            path = path[:path.rfind('/') + 1] + relative
+        result = f"{scheme}://{authority}{path}"
     if len(more) > 0:
         return relate(result, *more)
     
@@ -218,32 +228,33 @@ def one_giant_function(tester):
         with tester("writing files"):
             index_html_path = www / "index.html"
             assert RANDOM_NUMBER_PREFIX in index_html
-            index_html = re.sub(RANDOM_NUMBER_REGEX, RANDOM_NUMBER_PREFIX+str(random.randrange(9999999)), index_html)
-            index_html_path.write_text(index_html)
-            assert index_html_path.read_text() == index_html
+            index_html = RANDOM_NUMBER_RE.sub(RANDOM_NUMBER_PREFIX+str(random.randrange(9999999)), index_html)
+            index_html_bytes = index_html.encode()
+            index_html_path.write_bytes(index_html_bytes)
+            assert index_html_path.stat().st_size == len(index_html_bytes)
 
             base_css_path = www / "base.css"
-            base_css_path.write_text(base_css)
+            base_css_path.write_bytes(base_css.encode())
 
             deep_path = www / "deep"
             if not deep_path.is_dir():
                 deep_path.mkdir()
             
             deep_index_path = deep_path / "index.html"
-            deep_index_path.write_text(deep_index)
+            deep_index_path.write_bytes(deep_index.encode())
 
             deep_css_path = deep_path / "deep.css"
-            deep_css_path.write_text(deep_css)
+            deep_css_path.write_bytes(deep_css.encode())
 
             deeper_path = deep_path / "deeper"
             if not deeper_path.is_dir():
                 deeper_path.mkdir()
             
             deeper_index_path = deeper_path / "index.html"
-            deeper_index_path.write_text(deeper_index)
+            deeper_index_path.write_bytes(deeper_index.encode())
 
             deeper_css_path = deeper_path / "deeper.css"
-            deeper_css_path.write_text(deeper_css)
+            deeper_css_path.write_bytes(deeper_css.encode())
 
     tester.enter("your code is named server.py in the same directory as this file!")
     import server
@@ -302,14 +313,14 @@ def one_giant_function(tester):
         def ws_diff(expected, got):
             expected = list(map(repr_mostly, expected.splitlines(keepends=True)))
             got = list(map(repr_mostly, got.splitlines(keepends=True)))
-            return list(difflib.unified_diff(expected, got, fromfile="expected", tofile="recieved"))
+            return difflib.unified_diff(expected, got, fromfile="expected", tofile="recieved")
 
         if isinstance(expected, bytes):
             expected = expected.decode()
         if isinstance(got, bytes):
             got = got.decode()
         if expected != got:
-            sys.stderr.write(os.linesep.join(ws_diff(expected, got)+['']))
+            sys.stderr.writelines(line + os.linesep for line in ws_diff(expected, got))
         assert expected == got, "Didn't recieve what I expected, see diff above"
     
     def check_mime(expected, response):
@@ -366,6 +377,7 @@ def one_giant_function(tester):
         with tester("GET /doesnt_exist.html"):
             response = get("doesnt_exist.html")
             assert response.status == 404, f"Expected code 404 got {response.status}"
+            response.close()
 
     with tester("/deep"):
         with tester("GET /deep"):
@@ -374,6 +386,7 @@ def one_giant_function(tester):
             assert 'Location' in response.headers, f"Didn't find location header"
             location = response.headers['Location']
             assert location.endswith('/'), location
+            response.close()
 
         with tester("following redirect"):
             response = get(response.url, location)
@@ -383,6 +396,7 @@ def one_giant_function(tester):
             
             with tester("deep/deep.css"):
                 response = get(response.url, "deep.css")
+                response.close()
     
     with tester("/deep/deeper"):
         with tester("GET /deep/deeper"):
@@ -391,6 +405,7 @@ def one_giant_function(tester):
             assert 'Location' in response.headers, f"Didn't find location header"
             location = response.headers['Location']
             assert location.endswith('/'), location
+            response.close()
 
         with tester("following redirect"):
             response = get(response.url, location)
@@ -406,10 +421,12 @@ def one_giant_function(tester):
     with tester("how secure are you?"):
         response = get("../../../../../../../../../../etc/os-release")
         assert response.status in [403, 404], f"Expected code 403 got {response.status}"
+        response.close()
     
     with tester("testing 405s"):
         response = post('', data="heh?")
         assert response.status == 405, f"Expected code 405 got {response.status}"
+        response.close()
 
 
 def main():
@@ -5,46 +5,146 @@ A basic Python 3 HTTP/1.1 server.
 """
 
 import socketserver
+import socket
 import pathlib
+import os
+import stat
+import functools
+import logging
+
+logger = logging.getLogger(__name__)
 
 HOST = "0.0.0.0"
 PORT = 8000
 BUFSIZE = 4096
 LINE_ENDING='\r\n'
 SERVE_PATH = pathlib.Path('www').resolve()
+SERVE_ROOT = str(SERVE_PATH)
+SERVE_PATH_STR = SERVE_ROOT + os.sep
 HTTP_1_1 = 'HTTP/1.1'
+HTTP_1_1_BYTES = HTTP_1_1.encode('ascii')
+MAX_LINE = 8192
+MIME = {'.html': 'text/html', '.css': 'text/css'}
+DEFAULT_MIME = 'application/octet-stream'
+
+# The Connection header and the empty line ending the headers, by keep-alive state
+END_OF_HEADERS = {
+    True: f"Connection: keep-alive{LINE_ENDING}{LINE_ENDING}".encode('ascii'),
+    False: f"Connection: close{LINE_ENDING}{LINE_ENDING}".encode('ascii'),
+}
 
-class LabServer(socketserver.TCPServer):
+# Served files, keyed on path: ((mtime in ns, size), headers, content).
+# The headers stop short of the Connection header, which varies per request.
+_FILE_CACHE = {}
+# Files larger than this are sent with sendfile instead of being cached
+MAX_CACHED_FILE_SIZE = 64 * 1024
+
+class LabServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
     allow_reuse_address = True
 
 class LabServerTCPHandler(socketserver.StreamRequestHandler):
-    def __init__(self, *args, **kwargs):
-        self.charset = "UTF-8"
-        self.serve_path = pathlib.Path("www").resolve()
-        super().__init__(*args, **kwargs)
+    charset = "UTF-8"
+    # Buffer writes so each response reaches the socket in as few writes as
+    # possible; handle_request flushes once the response is complete
+    wbufsize = -1
+    rbufsize = 8192
+
+    def setup(self):
+        # Responses are written in full, so don't let Nagle's algorithm hold
+        # them back waiting for more data
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        super().setup()
 
     def recieve_line(self):
-        return self.rfile.readline().strip().decode(self.charset, 'ignore')
-    
-    def send_line(self, line):
-        self.wfile.write((line + LINE_ENDING).encode(self.charset, 'ignore'))
+        return self.rfile.readline(MAX_LINE).rstrip(b'\r\n')
     
+    def recieve_headers(self):
+        """
+        Read the request headers up to the empty line that ends them.
+
+        :return: A dict mapping lowercased header names to their values, both as bytes.
+        """
+        headers = {}
+        while True:
+            line = self.recieve_line()
+            if not line:
+                return headers
+            name, _, value = line.partition(b':')
+            headers[name.strip().lower()] = value.strip()
+
     def handle(self):
         """
-        Handles incoming HTTP requests. Parses the request, checks the method,
+        Handles HTTP requests on the connection until the client asks to close
+        it, the connection is closed, or a request can't be parsed.
+        """
+        while self.handle_request():
+            pass
+
+    def handle_request(self):
+        """
+        Handles a single HTTP request. Parses the request, checks the method,
         constructs the response based on the request path, and sends the appropriate
         response to the client.
+
+        :return: True if the connection should be kept open for another request, False otherwise.
         """
         start_line = self.recieve_line()  # Read the start line of the HTTP request
-        print("<", start_line)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("< %s", start_line.decode('ascii', 'ignore'))
 
-        # Split the start line into its method and path
-        start_line_split = start_line.split()
-        method = start_line_split[0]
-        path = start_line_split[1]
+        # The client closed the connection
+        if not start_line:
+            return False
+
+        # Split the start line into its method, path and version
+        start_line_split = start_line.split(None, 2)
+        if len(start_line_split) != 3:
+            return self.send_bad_request()
+        method, path, version = start_line_split
+        headers = self.recieve_headers()
+
+        # HTTP/1.1 connections are persistent unless the client asks otherwise
+        connection = headers.get(b'connection', b'').lower()
+        if version == HTTP_1_1_BYTES:
+            self.keep_alive = connection != b'close'
+        else:
+            self.keep_alive = connection == b'keep-alive'
+
+        # Discard any request body so the next request starts at the right place
+        try:
+            body_length = int(headers.get(b'content-length', 0))
+        except ValueError:
+            return self.send_bad_request()
+        if body_length > 0:
+            self.rfile.read(body_length)
+
+        self.send_response(method, path.decode('ascii', 'ignore'))
+        self.wfile.flush()
+        return self.keep_alive
+
+    def send_bad_request(self):
+        """
+        Sends a 400 Bad Request response for a request that can't be parsed,
+        and closes the connection, since the rest of the stream can't be trusted.
+
+        :return: False, so the connection is closed.
+        """
+        self.keep_alive = False
+        self.send_headers('400 Bad Request', 'text/html', 0)
+        self.wfile.flush()
+        return False
+
+    def send_response(self, method, path):
+        """
+        Constructs and sends the response for a parsed request.
+
+        :param method: The HTTP method of the request, as bytes.
+        :param path: The path requested.
+        """
 
         # Handle only GET method, send 405 Method Not Allowed for other methods
-        if method != 'GET':
+        if method != b'GET':
             self.send_headers('405 Method Not Allowed', 'text/html', 0)
             return
         
@@ -56,32 +156,45 @@ class LabServerTCPHandler(socketserver.StreamRequestHandler):
             self.send_headers('404 Not Found', 'text/html', 0)
             return
 
+        # A single stat tells whether the path exists and what it is
+        path_stat = stat_or_none(secure_path)
+
+        # Send 404 Not Found for non-existing paths
+        if path_stat is None:
+            self.send_headers('404 Not Found', 'text/html', 0)
+
         # Redirect to path with '/' if it's a directory and doesn't end with '/'
-        if secure_path.is_dir() and not path.endswith('/'):
+        elif stat.S_ISDIR(path_stat.st_mode) and not path.endswith('/'):
             self.send_redirect(path + '/', '301 Moved Permanently')
-            return
 
         # Serve the index.html file if the path is a directory
-        if secure_path.is_dir():
-            index_path = secure_path / 'index.html'
-            if index_path.exists():
-                self.send_file_content(index_path, 'text/html')
+        elif stat.S_ISDIR(path_stat.st_mode):
+            index_path = os.path.join(secure_path, 'index.html')
+            index_stat = stat_or_none(index_path)
+            if index_stat is not None and stat.S_ISREG(index_stat.st_mode):
+                self.send_file_content(index_path, MIME['.html'], index_stat)
             else:
                 self.send_headers('404 Not Found', 'text/html', 0)
 
         # Serve the file if the path is a file
-        elif secure_path.is_file():
-            content_type = ''
-            if str(secure_path).endswith('.html'):
-                content_type = 'text/html'
-            elif str(secure_path).endswith('.css'):
-                content_type = 'text/css'
-
-            self.send_file_content(secure_path, content_type)
-        # Send 404 Not Found for non-existing paths
+        elif stat.S_ISREG(path_stat.st_mode):
+            content_type = MIME.get(os.path.splitext(secure_path)[1], DEFAULT_MIME)
+
+            self.send_file_content(secure_path, content_type, path_stat)
+        # Send 404 Not Found for anything else
         else:
             self.send_headers('404 Not Found', 'text/html', 0)
 
+    def send_header_lines(self, *lines):
+        """
+        Sends the given header lines, followed by the Connection header and
+        the empty line ending the headers, in a single write.
+
+        :param lines: The status line and header lines, without line endings.
+        """
+        header_block = ''.join(line + LINE_ENDING for line in lines)
+        self.wfile.write(header_block.encode(self.charset, 'ignore') + END_OF_HEADERS[self.keep_alive])
+
     def send_redirect(self, new_path, status_code):
         """
         Sends a redirect response to the client.
@@ -89,14 +202,14 @@ class LabServerTCPHandler(socketserver.StreamRequestHandler):
         :param new_path: The path to redirect to.
         :param status_code: The HTTP status code for redirection.
         """
-        # Send the HTTP status line with the status code
-        self.send_line(f"{HTTP_1_1} {status_code}")
-        # Send the Location header with the new path
-        self.send_line(f"Location: {new_path}")
-        # Close the connection after sending the response
-        self.send_line("Connection: close")
-        # Send an empty line to indicate the end of the headers
-        self.send_line("")
+        self.send_header_lines(
+            # The HTTP status line with the status code
+            f"{HTTP_1_1} {status_code}",
+            # The Location header with the new path
+            f"Location: {new_path}",
+            # The redirect has no body
+            "Content-Length: 0",
+        )
 
     def send_headers(self, status_code, content_type, content_length):
         """
@@ -106,55 +219,104 @@ class LabServerTCPHandler(socketserver.StreamRequestHandler):
         :param content_type: The type of the response content.
         :param content_length: The length of the response content.
         """
-        # Send the HTTP status line
-        self.send_line(f"{HTTP_1_1} {status_code}")
-        # Send the Content-Type header
-        self.send_line(f"Content-Type: {content_type}")
-        # Send the Content-Length header
-        self.send_line(f"Content-Length: {content_length}")
-        # Close the connection after sending the response
-        self.send_line("Connection: close")
-        # Send an empty line to indicate the end of the headers
-        self.send_line("")
+        self.send_header_lines(
+            # The HTTP status line
+            f"{HTTP_1_1} {status_code}",
+            # The Content-Type header
+            f"Content-Type: {content_type}",
+            # The Content-Length header
+            f"Content-Length: {content_length}",
+        )
 
-    def send_file_content(self, file_path, content_type):
+    def send_file_content(self, file_path, content_type, file_stat):
         """
-        Read and send the file content.
+        Send the file content, reading it from disk only if it isn't cached
+        or has been modified since it was cached. Large files aren't cached
+        and are sent with send_large_file instead.
 
         :param file_path: The path to the file to read and extract the content.
         :param content_type: The type of the file.
+        :param file_stat: The os.stat result for the file.
         """
-        # Open and read the file
-        with open(file_path, 'rb') as file:
-            content = file.read()
+        if file_stat.st_size > MAX_CACHED_FILE_SIZE:
+            self.send_large_file(file_path, content_type)
+            return
+
+        # A rewrite within the same timestamp still changes the size
+        version = (file_stat.st_mtime_ns, file_stat.st_size)
+        entry = _FILE_CACHE.get(file_path)
+        if entry is None or entry[0] != version:
+            # Open and read the file
+            with open(file_path, 'rb') as file:
+                content = file.read()
             # Determine the content length
-            content_length = str(len(content))
-            # Send headers with OK status, content type, and content length
+            content_length = len(content)
+            # Build the headers with OK status, content type, and content length
+            headers = (
+                f"{HTTP_1_1} 200 OK{LINE_ENDING}"
+                f"Content-Type: {content_type}{LINE_ENDING}"
+                f"Content-Length: {content_length}{LINE_ENDING}"
+            ).encode(self.charset, 'ignore')
+            entry = (version, headers, content)
+            _FILE_CACHE[file_path] = entry
+
+        _, headers, content = entry
+        # Write the headers and the content to the response in one go
+        self.wfile.write(headers + END_OF_HEADERS[self.keep_alive] + content)
+
+    def send_large_file(self, file_path, content_type):
+        """
+        Send the file content straight from the file to the socket with
+        sendfile, without reading it into memory. socket.sendfile falls back
+        to plain sends by itself where os.sendfile can't be used.
+
+        :param file_path: The path to the file to send.
+        :param content_type: The type of the file.
+        """
+        with open(file_path, 'rb') as file:
+            # Determine the content length without reading the file
+            content_length = os.fstat(file.fileno()).st_size
             self.send_headers('200 OK', content_type, content_length)
-            # Write the content to the response
-            self.wfile.write(content)
+            # The headers must reach the socket before the file content
+            self.wfile.flush()
+            self.connection.sendfile(file, 0, content_length)
 
     def secure_path(self, path):
         """
-        Verify if the given path is within the self.serve_path directory.
+        Verify if the given path is within the SERVE_PATH directory.
 
-        Note: This method is adapted from a Stack Overflow discussion:
-        "How to check whether a directory is a sub-directory of another directory"
-        URL: https://stackoverflow.com/questions/3812849/how-to-check-whether-a-directory-is-a-sub-directory-of-another-directory
-        Date Accessed: January 20, 2024
+        The path is resolved with os.path.realpath, so symlinks can't lead
+        outside SERVE_PATH, and checked with a single prefix comparison.
+        Results are memoized by _resolve, keyed on the raw request path, so
+        symlinks under SERVE_PATH are assumed not to change while serving.
 
-        :param path: The path (relative to self.serve_path) to check and resolve.
-        :return: The resolved pathlib.Path object if the path is a valid subdirectory of self.serve_path, None otherwise.
+        :param path: The path (relative to SERVE_PATH) to check and resolve.
+        :return: The resolved path string if the path is within SERVE_PATH, None otherwise.
         """
-    
-        # Resolve the path and check if it is within the serve path
-        resolved_path = (self.serve_path / path.strip('/')).resolve()
-        if self.serve_path in resolved_path.parents or resolved_path == self.serve_path:
-            # Return the resolved path if it is within the serve path
-            return resolved_path
-        # Return None if the path is not within the serve path
+        return _resolve(path)
+
+@functools.lru_cache(maxsize=1024)
+def _resolve(path):
+    # Resolve the path and check if it is within the serve path
+    cleaned = os.path.realpath(os.path.join(SERVE_ROOT, path.lstrip('/')))
+    if cleaned == SERVE_ROOT or cleaned.startswith(SERVE_PATH_STR):
+        # Return the resolved path if it is within the serve path
+        return cleaned
+    # Return None if the path is not within the serve path
+    return None
+
+def stat_or_none(path):
+    """
+    :return: The os.stat result for the path, or None if it can't be stat'ed.
+    """
+    try:
+        return os.stat(path)
+    except OSError:
         return None
+
 def main():
+    # Set LAB_DEBUG to log each request line
+    logging.basicConfig(level=logging.DEBUG if os.environ.get("LAB_DEBUG") else logging.WARNING)
     # From https://docs.python.org/3/library/socketserver.html, The Python Software Foundation, downloaded 2024-01-07
     with LabServer((HOST, PORT), LabServerTCPHandler) as server:
         server.serve_forever()